@@ -1,28 +1,298 @@
+import glob
+import gzip
+import hashlib
+import io
+import json
 import os
+import shutil
 import sqlite3
-from datetime import datetime
-from urllib.parse import quote
-from flask import Flask, render_template, request, redirect, url_for, flash, session, send_file, make_response, jsonify
+import tempfile
+import threading
+import time
+import urllib.request
+import uuid
+from datetime import datetime, timedelta
+from functools import lru_cache
+from flask import Flask, render_template, request, redirect, url_for, flash, session, send_file, make_response, jsonify, Response, g
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
 from werkzeug.security import generate_password_hash, check_password_hash
-from openpyxl import Workbook
+import click
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("SECRET_KEY", "mgm_store_secret_key")
+# compiled templates survive restarts and are shared by all workers; Jinja's default directory is
+# private to this user (0700, owner checked), which matters because cached bytecode is unmarshalled
+app.jinja_options = {**app.jinja_options, "bytecode_cache": FileSystemBytecodeCache()}
+app.config["FRAGMENT_CACHE"] = True
 
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 IS_VERCEL = bool(os.environ.get("VERCEL"))
-DB_BASE = "/tmp" if IS_VERCEL else BASE_DIR
+DB_BASE = tempfile.gettempdir() if IS_VERCEL else BASE_DIR
 DB_PATH = os.path.join(DB_BASE, "mgm_store.db")
-EXCEL_DIR = os.path.join("/tmp" if IS_VERCEL else BASE_DIR, "excel")
+EXCEL_DIR = os.path.join(DB_BASE, "excel")
+BACKUP_DIR = os.path.join(DB_BASE, "backups")
+BACKUP_KEEP = 7
+# pages copied per backup step; writers only ever wait for one step
+BACKUP_STEP_PAGES = 256
+# comma-separated endpoints that receive batched order events
+WEBHOOK_URLS = [u.strip() for u in os.environ.get("WEBHOOK_URLS", "").split(",") if u.strip()]
+# shared secret for consumers of /events that are not logged in as admin
+EVENTS_TOKEN = os.environ.get("EVENTS_TOKEN")
+OUTBOX_BATCH = 50
+OUTBOX_MAX_ATTEMPTS = 10
+OUTBOX_POLL_SECONDS = 2
+# a claimed batch is retried by another dispatcher if not settled within this many seconds
+OUTBOX_LEASE_SECONDS = 60
+# an SSE connection holds a worker thread; close it after this long and let the client resume by Last-Event-ID
+EVENT_STREAM_SECONDS = 30
+# prebuilt, already-seeded database copied into /tmp on a cold serverless instance
+SNAPSHOT_PATH = os.path.join(BASE_DIR, "snapshot", "mgm_store.db")
+# bump whenever init_db() changes the schema or seed data, then run `flask --app app build-snapshot`
+SCHEMA_VERSION = 9
+LOW_STOCK_THRESHOLD = 5
+# retries arrive within seconds or minutes; older idempotency keys are dropped
+IDEMPOTENCY_KEY_TTL = timedelta(hours=24)
+# order statuses whose total counts towards revenue
+REVENUE_STATUSES = ("confirmed", "dispatched")
+_db_ready = False
+_dispatcher_started = False
+# one lock per QR being rendered: {(uri, fmt): Lock}
+_qr_locks = {}
+_qr_locks_guard = threading.Lock()
+# rendered template fragments: {key: (version, html)}
+_fragments = {}
+# per-process product cache: (catalog_version, catalog_epoch, products, by_id). Rows whose
+# products.version moved past the cached catalog_version are refetched; catalog_epoch forces a full reload
+_catalog_cache = (None, None, [], {})
 
-def get_db():
-    conn = sqlite3.connect(DB_PATH)
+def get_db(path=None):
+    conn = sqlite3.connect(path or DB_PATH, timeout=15)
     conn.row_factory = sqlite3.Row
     return conn
 
-def init_db():
+def begin_write(conn, attempts=5):
+    # take the write lock up front so read-then-write sequences (stock checks) can't interleave
+    for attempt in range(attempts):
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            return
+        except sqlite3.OperationalError as e:
+            if "locked" not in str(e) or attempt == attempts - 1:
+                raise
+            time.sleep(0.05 * 2 ** attempt)
+
+def bump_version(cur, key="catalog_version"):
+    cur.execute("UPDATE meta SET value = value + 1 WHERE key=?", (key,))
+
+def touch_product(cur, pid):
+    # stamp the product with the new catalog_version so caches refetch just this row
+    bump_version(cur)
+    cur.execute("UPDATE products SET version=(SELECT value FROM meta WHERE key='catalog_version') WHERE id=?", (pid,))
+
+def today():
+    return datetime.utcnow().date().isoformat()
+
+# day an order's revenue is attributed to: its latest successful payment, else when it was placed
+REVENUE_DAY_SQL = """date(COALESCE(
+    (SELECT MAX(paid_at) FROM payments WHERE order_id = o.id AND status = 'success'),
+    o.created_at))"""
+
+def bump_metric(cur, key, delta):
+    cur.execute(
+        "INSERT INTO metrics (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = value + excluded.value",
+        (key, delta),
+    )
+
+def rebuild_metrics(cur):
+    # full recompute; the write routes keep these counters current afterwards
+    cur.execute("DELETE FROM metrics")
+    cur.execute("INSERT INTO metrics (key, value) SELECT 'orders:' || status, COUNT(*) FROM orders WHERE status IS NOT NULL GROUP BY status")
+    cur.execute("INSERT INTO metrics (key, value) SELECT 'products:out_of_stock', COUNT(*) FROM products WHERE stock <= 0")
+    cur.execute("""
+        INSERT INTO metrics (key, value)
+        SELECT 'signups:' || date(created_at), COUNT(*) FROM users
+        WHERE role='customer' GROUP BY date(created_at)
+    """)
+    # orders whose latest payment still waits for an admin, as listed on the orders page
+    cur.execute("""
+        INSERT INTO metrics (key, value)
+        SELECT 'payments:submitted', COUNT(*) FROM payments p
+        WHERE p.status = 'submitted' AND p.id = (SELECT MAX(id) FROM payments WHERE order_id = p.order_id)
+    """)
+    placeholders = ", ".join("?" for _ in REVENUE_STATUSES)
+    cur.execute(
+        f"""
+        INSERT INTO metrics (key, value)
+        SELECT 'revenue:' || {REVENUE_DAY_SQL}, SUM(o.total)
+        FROM orders o WHERE o.status IN ({placeholders})
+        GROUP BY 1
+        """,
+        REVENUE_STATUSES,
+    )
+
+def dashboard_metrics():
+    day = today()
+    keys = {
+        "orders_pending": "orders:pending",
+        "awaiting_verification": "payments:submitted",
+        "revenue_today": f"revenue:{day}",
+        "out_of_stock": "products:out_of_stock",
+        "signups_today": f"signups:{day}",
+    }
     conn = get_db()
     cur = conn.cursor()
+    cur.execute(
+        f"SELECT key, value FROM metrics WHERE key IN ({', '.join('?' for _ in keys)})",
+        list(keys.values()),
+    )
+    values = {r["key"]: r["value"] for r in cur.fetchall()}
+    conn.close()
+    data = {name: values.get(key) or 0 for name, key in keys.items()}
+    for name in ("orders_pending", "awaiting_verification", "out_of_stock", "signups_today"):
+        data[name] = int(data[name])
+    data["date"] = day
+    return data
+
+def emit_event(cur, event, order_id, **data):
+    # written in the caller's transaction, so an event exists iff the change committed
+    cur.execute(
+        "INSERT INTO outbox (event, order_id, payload, created_at) VALUES (?, ?, ?, ?)",
+        (event, order_id, json.dumps(data), datetime.utcnow().isoformat()),
+    )
+
+def settle_payment(cur, payment):
+    # call before confirming or rejecting an order's latest payment
+    if payment and payment["status"] == "submitted":
+        bump_metric(cur, "payments:submitted", -1)
+
+def record_new_order(cur, oid, total):
+    bump_metric(cur, "orders:pending", 1)
+    emit_event(cur, "order.created", oid, status="pending", total=total)
+
+def set_order_status(cur, oid, status):
+    # returns the previous status; stock, metrics and the outbox move with the transition.
+    # Raises ValueError when a cancelled order is reopened but its items are no longer in stock
+    cur.execute(f"SELECT o.status, o.total, {REVENUE_DAY_SQL} AS revenue_day FROM orders o WHERE o.id=?", (oid,))
+    order = cur.fetchone()
+    if not order or order["status"] == status:
+        return order["status"] if order else None
+    if status == "cancelled":
+        restock_order(cur, oid)
+    elif order["status"] == "cancelled":
+        reserve_order(cur, oid)
+    cur.execute("UPDATE orders SET status=? WHERE id=?", (status, oid))
+    emit_event(cur, "order.status_changed", oid, previous=order["status"], status=status, total=order["total"])
+    bump_metric(cur, f"orders:{order['status']}", -1)
+    bump_metric(cur, f"orders:{status}", 1)
+    # same attribution as rebuild_metrics(), so a later cancellation reverses the day it was counted on;
+    # callers must change the order status before marking its payment failed
+    was_revenue = order["status"] in REVENUE_STATUSES
+    if was_revenue != (status in REVENUE_STATUSES):
+        bump_metric(cur, f"revenue:{order['revenue_day']}", order["total"] if not was_revenue else -order["total"])
+    return order["status"]
+
+def move_stock(cur, pid, delta, reason, order_id=None):
+    # every stock change goes through the ledger; products.stock is the cached running total
+    cur.execute("SELECT stock FROM products WHERE id=?", (pid,))
+    old = cur.fetchone()["stock"]
+    cur.execute(
+        "INSERT INTO inventory_movements (product_id, delta, reason, order_id, created_at) VALUES (?, ?, ?, ?, ?)",
+        (pid, delta, reason, order_id, datetime.utcnow().isoformat()),
+    )
+    cur.execute("UPDATE products SET stock = stock + ? WHERE id=?", (delta, pid))
+    touch_product(cur, pid)
+    change = int(old + delta <= 0) - int(old <= 0)
+    if change:
+        bump_metric(cur, "products:out_of_stock", change)
+
+def order_stock(cur, oid):
+    # quantities per product still in the catalog; deleted products have no stock to move
+    cur.execute("""
+        SELECT oi.product_id, SUM(oi.quantity) AS quantity, p.stock
+        FROM order_items oi
+        JOIN products p ON p.id = oi.product_id
+        WHERE oi.order_id=?
+        GROUP BY oi.product_id
+    """, (oid,))
+    return cur.fetchall()
+
+def restock_order(cur, oid):
+    for item in order_stock(cur, oid):
+        move_stock(cur, item["product_id"], item["quantity"], "cancel", oid)
+
+def reserve_order(cur, oid):
+    # a cancelled order coming back takes its items out of stock again
+    items = order_stock(cur, oid)
+    short = [str(i["product_id"]) for i in items if i["stock"] < i["quantity"]]
+    if short:
+        raise ValueError(f"Insufficient stock to reopen order #{oid} (products {', '.join(short)})")
+    for item in items:
+        move_stock(cur, item["product_id"], -item["quantity"], "order", oid)
+
+def idempotency_key():
+    return request.headers.get("Idempotency-Key") or request.form.get("idempotency_key")
+
+def replayed_order(key, endpoint, user_id):
+    if not key:
+        return None
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT order_id FROM idempotency_keys WHERE key=? AND endpoint=? AND user_id=?",
+        (key, endpoint, user_id or 0),
+    )
+    row = cur.fetchone()
+    conn.close()
+    return row["order_id"] if row else None
+
+def remember_request(cur, key, endpoint, user_id, order_id):
+    # raises IntegrityError if a concurrent submission with the same key committed first
+    if key:
+        now = datetime.utcnow()
+        cur.execute("DELETE FROM idempotency_keys WHERE created_at < ?", ((now - IDEMPOTENCY_KEY_TTL).isoformat(),))
+        cur.execute(
+            "INSERT INTO idempotency_keys (key, endpoint, user_id, order_id, created_at) VALUES (?, ?, ?, ?, ?)",
+            (key, endpoint, user_id or 0, order_id, now.isoformat()),
+        )
+
+def get_catalog():
+    global _catalog_cache
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("SELECT key, value FROM meta WHERE key IN ('catalog_version', 'catalog_epoch')")
+    meta = {r["key"]: r["value"] for r in cur.fetchall()}
+    version, epoch = meta["catalog_version"], meta["catalog_epoch"]
+    cached_version, cached_epoch, products, by_id = _catalog_cache
+    if cached_version is None or cached_epoch != epoch:
+        cur.execute("SELECT * FROM products ORDER BY id DESC")
+        products = cur.fetchall()
+        by_id = {p["id"]: p for p in products}
+    elif cached_version != version:
+        cur.execute("SELECT * FROM products WHERE version > ?", (cached_version,))
+        changed = cur.fetchall()
+        if changed:
+            added = any(p["id"] not in by_id for p in changed)
+            by_id = dict(by_id)
+            by_id.update((p["id"], p) for p in changed)
+            if added:
+                products = sorted(by_id.values(), key=lambda p: p["id"], reverse=True)
+            else:
+                products = [by_id[p["id"]] for p in products]
+    _catalog_cache = (version, epoch, products, by_id)
+    conn.close()
+    return version, products, by_id
+
+def init_db(path=None):
+    conn = get_db(path)
+    cur = conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    # one transaction under the write lock: concurrent workers wait here, then find the schema current
+    begin_write(conn)
+    cur.execute("PRAGMA user_version")
+    if cur.fetchone()[0] >= SCHEMA_VERSION:
+        conn.close()
+        return
     cur.execute("""
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -78,27 +348,82 @@ def init_db():
             FOREIGN KEY(order_id) REFERENCES orders(id)
         )
     """)
-    conn.commit()
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER
+        )
+    """)
+    cur.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('catalog_version', 0)")
+    cur.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('catalog_epoch', 0)")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            key TEXT,
+            endpoint TEXT,
+            user_id INTEGER,
+            order_id INTEGER,
+            created_at TEXT,
+            UNIQUE(key, endpoint, user_id)
+        )
+    """)
+    # anonymous requests are stored as user 0: NULLs would never collide in the UNIQUE constraint
+    cur.execute("UPDATE idempotency_keys SET user_id=0 WHERE user_id IS NULL")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created_at ON idempotency_keys(created_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_payments_transaction_id ON payments(transaction_id)")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS inventory_movements (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            product_id INTEGER,
+            delta INTEGER,
+            reason TEXT,
+            order_id INTEGER,
+            created_at TEXT,
+            FOREIGN KEY(product_id) REFERENCES products(id),
+            FOREIGN KEY(order_id) REFERENCES orders(id)
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_inventory_movements_product ON inventory_movements(product_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_products_stock ON products(stock)")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS metrics (
+            key TEXT PRIMARY KEY,
+            value REAL
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            event TEXT,
+            order_id INTEGER,
+            payload TEXT,
+            created_at TEXT,
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at REAL DEFAULT 0,
+            delivered_at TEXT,
+            last_error TEXT
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_outbox_undelivered ON outbox(next_attempt_at) WHERE delivered_at IS NULL")
     cur.execute("PRAGMA table_info(orders)")
     cols = [r[1] for r in cur.fetchall()]
     if "shipping_address" not in cols:
         cur.execute("ALTER TABLE orders ADD COLUMN shipping_address TEXT")
-        conn.commit()
     # detailed address columns
     for col in ["door_no","street","landmark","place","district","state","alt_mobile","pincode"]:
         if col not in cols:
             cur.execute(f"ALTER TABLE orders ADD COLUMN {col} TEXT")
-            conn.commit()
     cur.execute("PRAGMA table_info(products)")
     pcols = [r[1] for r in cur.fetchall()]
     if "image_url" not in pcols:
         cur.execute("ALTER TABLE products ADD COLUMN image_url TEXT")
-        conn.commit()
+    if "version" not in pcols:
+        cur.execute("ALTER TABLE products ADD COLUMN version INTEGER DEFAULT 0")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_products_version ON products(version)")
     cur.execute("PRAGMA table_info(payments)")
     paycols = [r[1] for r in cur.fetchall()]
     if "notes" not in paycols:
         cur.execute("ALTER TABLE payments ADD COLUMN notes TEXT")
-        conn.commit()
     cur.execute("SELECT id FROM users WHERE role=?", ("admin",))
     admin = cur.fetchone()
     if not admin:
@@ -113,9 +438,6 @@ def init_db():
                 datetime.utcnow().isoformat(),
             ),
         )
-        conn.commit()
-    if not os.path.exists(EXCEL_DIR):
-        os.makedirs(EXCEL_DIR, exist_ok=True)
     cur.execute("SELECT COUNT(*) FROM products")
     pcnt = cur.fetchone()[0]
     if pcnt == 0:
@@ -127,10 +449,236 @@ def init_db():
         cur.execute("INSERT INTO products (name, description, price, stock, created_at, image_url) VALUES (?, ?, ?, ?, ?, ?)", ("Denim Jeans", "Blue slim fit", 1299.0, 30, datetime.utcnow().isoformat(), j_img))
         cur.execute("INSERT INTO products (name, description, price, stock, created_at, image_url) VALUES (?, ?, ?, ?, ?, ?)", ("Men Kurta", "Festive wear", 999.0, 20, datetime.utcnow().isoformat(), k_img))
         cur.execute("INSERT INTO products (name, description, price, stock, created_at, image_url) VALUES (?, ?, ?, ?, ?, ?)", ("Silk Saree", "Traditional saree", 2499.0, 15, datetime.utcnow().isoformat(), s_img))
-        conn.commit()
+    # opening balance for products that predate the ledger
+    cur.execute(
+        """
+        INSERT INTO inventory_movements (product_id, delta, reason, created_at)
+        SELECT id, stock, 'opening', ? FROM products
+        WHERE id NOT IN (SELECT product_id FROM inventory_movements)
+        """,
+        (datetime.utcnow().isoformat(),),
+    )
+    # also backfills counters added after the metrics table was first populated
+    cur.execute("SELECT 1 FROM metrics WHERE key='payments:submitted'")
+    if cur.fetchone() is None:
+        rebuild_metrics(cur)
+    cur.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    conn.commit()
+    conn.close()
+
+def restore_snapshot():
+    if os.path.exists(DB_PATH) or not os.path.exists(SNAPSHOT_PATH):
+        return False
+    tmp_path = f"{DB_PATH}.{os.getpid()}.tmp"
+    shutil.copyfile(SNAPSHOT_PATH, tmp_path)
+    os.replace(tmp_path, DB_PATH)
+    return True
+
+def schema_is_current():
+    conn = get_db()
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    conn.close()
+    return version >= SCHEMA_VERSION
+
+def backup_db(compress=False, keep=BACKUP_KEEP):
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    stamp = datetime.utcnow().strftime("%Y%m%dT%H%M%S%f")
+    path = os.path.join(BACKUP_DIR, f"mgm_store-{stamp}.db")
+    src = sqlite3.connect(DB_PATH, timeout=15)
+    dst = sqlite3.connect(path)
+    src.backup(dst, pages=BACKUP_STEP_PAGES, sleep=0.005)
+    dst.close()
+    src.close()
+    if compress:
+        with open(path, "rb") as f_in, gzip.open(f"{path}.gz", "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.remove(path)
+        path = f"{path}.gz"
+    rotate_backups(keep)
+    return path
+
+def rotate_backups(keep):
+    # timestamped names sort chronologically
+    backups = sorted(glob.glob(os.path.join(BACKUP_DIR, "mgm_store-*.db*")))
+    for old in backups[:-keep] if keep > 0 else []:
+        os.remove(old)
+
+def meta_value_of(conn, key):
+    try:
+        row = conn.execute("SELECT value FROM meta WHERE key=?", (key,)).fetchone()
+    except sqlite3.OperationalError:
+        return 0
+    return row[0] if row else 0
+
+def restore_db(path):
+    fd, tmp_path = tempfile.mkstemp(suffix=".db", dir=DB_BASE)
+    os.close(fd)
+    try:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rb") as f_in, open(tmp_path, "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        candidate = sqlite3.connect(tmp_path)
+        try:
+            result = candidate.execute("PRAGMA integrity_check").fetchone()[0]
+            if result != "ok":
+                raise ValueError(f"Backup failed integrity check: {result}")
+            version = candidate.execute("PRAGMA user_version").fetchone()[0]
+            if version > SCHEMA_VERSION:
+                raise ValueError(f"Backup schema version {version} is newer than this app ({SCHEMA_VERSION})")
+        finally:
+            candidate.close()
+        # bring older backups up to the current schema before anything touches the live database
+        init_db(tmp_path)
+        candidate = sqlite3.connect(tmp_path)
+        live = sqlite3.connect(DB_PATH, timeout=15)
+        try:
+            # move both counters past every value a worker may have cached so product caches reload,
+            # and restamp every product so no restored row shares a fragment version with a live one
+            for key in ("catalog_version", "catalog_epoch"):
+                candidate.execute("UPDATE meta SET value = MAX(value, ?) + 1 WHERE key=?", (meta_value_of(live, key), key))
+            candidate.execute("UPDATE products SET version=(SELECT value FROM meta WHERE key='catalog_version')")
+            # never hand out an order or event id twice: /events cursors and webhook consumers key on them
+            for table in ("orders", "outbox"):
+                row = live.execute("SELECT seq FROM sqlite_sequence WHERE name=?", (table,)).fetchone()
+                live_seq = row[0] if row else 0
+                updated = candidate.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name=?", (live_seq, table))
+                if updated.rowcount == 0:
+                    candidate.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (table, live_seq))
+            candidate.commit()
+            # one backup step copies everything under the live write lock, so the swap is all-or-nothing
+            candidate.backup(live)
+        finally:
+            live.close()
+            candidate.close()
+    finally:
+        for leftover in (tmp_path, f"{tmp_path}-wal", f"{tmp_path}-shm"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+def event_dict(row):
+    return {
+        "id": row["id"],
+        "event": row["event"],
+        "order_id": row["order_id"],
+        "data": json.loads(row["payload"]),
+        "created_at": row["created_at"],
+    }
+
+def read_events(after, limit):
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("SELECT * FROM outbox WHERE id > ? ORDER BY id LIMIT ?", (after, limit))
+    events = [event_dict(r) for r in cur.fetchall()]
+    conn.close()
+    return events
+
+def claim_events(limit=OUTBOX_BATCH):
+    now = time.time()
+    conn = get_db()
+    cur = conn.cursor()
+    begin_write(conn)
+    cur.execute(
+        "SELECT * FROM outbox WHERE delivered_at IS NULL AND next_attempt_at <= ? AND attempts < ? ORDER BY id LIMIT ?",
+        (now, OUTBOX_MAX_ATTEMPTS, limit),
+    )
+    rows = cur.fetchall()
+    if rows:
+        cur.executemany(
+            "UPDATE outbox SET next_attempt_at=? WHERE id=?",
+            [(now + OUTBOX_LEASE_SECONDS, r["id"]) for r in rows],
+        )
+    conn.commit()
+    conn.close()
+    return rows
+
+def post_events(url, events):
+    body = json.dumps({"events": events}).encode()
+    req = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"}, method="POST")
+    with urllib.request.urlopen(req, timeout=10) as resp:
+        resp.read()
+
+def dispatch_outbox():
+    rows = claim_events()
+    if not rows:
+        return 0
+    events = [event_dict(r) for r in rows]
+    error = None
+    for url in WEBHOOK_URLS:
+        try:
+            post_events(url, events)
+        except Exception as e:
+            error = f"{url}: {e}"
+            break
+    conn = get_db()
+    cur = conn.cursor()
+    begin_write(conn)
+    if error is None:
+        cur.executemany(
+            "UPDATE outbox SET delivered_at=?, attempts=attempts+1, last_error=NULL WHERE id=?",
+            [(datetime.utcnow().isoformat(), r["id"]) for r in rows],
+        )
+    else:
+        # delivery is at-least-once: consumers dedupe on the event id
+        cur.executemany(
+            "UPDATE outbox SET attempts=attempts+1, next_attempt_at=?, last_error=? WHERE id=?",
+            [(time.time() + min(2 ** r["attempts"], 3600), error, r["id"]) for r in rows],
+        )
+        app.logger.warning("Outbox delivery failed, will retry: %s", error)
+    conn.commit()
     conn.close()
+    return len(rows) if error is None else 0
+
+def run_outbox_dispatcher():
+    while True:
+        try:
+            delivered = dispatch_outbox()
+        except Exception:
+            app.logger.exception("Outbox dispatcher error")
+            delivered = 0
+        if delivered < OUTBOX_BATCH:
+            time.sleep(OUTBOX_POLL_SECONDS)
+
+def start_outbox_dispatcher():
+    # one thread per worker process; claim_events() leases rows so workers don't double-send
+    global _dispatcher_started
+    if _dispatcher_started or not WEBHOOK_URLS or IS_VERCEL:
+        return
+    _dispatcher_started = True
+    threading.Thread(target=run_outbox_dispatcher, name="outbox-dispatcher", daemon=True).start()
+
+def build_upi_uri(order):
+    return f"upi://pay?pa=7418304663@upi&pn=MGM%20Cloths&am={order['total']}&cu=INR&tn=Order%20{order['id']}"
+
+@lru_cache(maxsize=512)
+def _render_qr(uri, fmt):
+    import segno
+    buf = io.BytesIO()
+    qr = segno.make(uri, error="m")
+    if fmt == "png":
+        qr.save(buf, kind="png", scale=6, border=2)
+    else:
+        qr.save(buf, kind="svg", scale=6, border=2, xmldecl=False)
+    return buf.getvalue()
+
+def qr_etag(uri, fmt):
+    return hashlib.sha1(f"{fmt}:{uri}".encode()).hexdigest()
+
+def qr_image(uri, fmt):
+    # concurrent payers on the same order share a single render; other orders render in parallel
+    key = (uri, fmt)
+    with _qr_locks_guard:
+        lock = _qr_locks.setdefault(key, threading.Lock())
+    try:
+        with lock:
+            return _render_qr(uri, fmt)
+    finally:
+        with _qr_locks_guard:
+            if _qr_locks.get(key) is lock:
+                del _qr_locks[key]
 
 def export_table_to_excel(table_name, file_name):
+    # openpyxl is slow to import; only pay for it when a workbook is actually written
+    from openpyxl import Workbook
     conn = get_db()
     cur = conn.cursor()
     cur.execute(f"SELECT * FROM {table_name}")
@@ -144,8 +692,12 @@ def export_table_to_excel(table_name, file_name):
             ws.append([r[k] for k in r.keys()])
     else:
         ws.append(["no_data"])
+    os.makedirs(EXCEL_DIR, exist_ok=True)
     path = os.path.join(EXCEL_DIR, file_name)
-    wb.save(path)
+    # workers may export at the same time; readers only ever see a complete workbook
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    wb.save(tmp_path)
+    os.replace(tmp_path, path)
     conn.close()
     return path
 
@@ -158,11 +710,16 @@ def current_user():
     uid = session.get("user_id")
     if not uid:
         return None
+    # routes and the layout both ask for the user; look it up once per request
+    cached = g.get("current_user")
+    if cached and cached[0] == uid:
+        return cached[1]
     conn = get_db()
     cur = conn.cursor()
     cur.execute("SELECT * FROM users WHERE id=?", (uid,))
     u = cur.fetchone()
     conn.close()
+    g.current_user = (uid, u)
     return u
 
 def require_role(role):
@@ -173,6 +730,27 @@ def require_role(role):
 def inject_user():
     return {"user": current_user()}
 
+@app.template_global()
+def fragment(template, key, version, **context):
+    # rendered HTML is reused until version changes; pass the catalog version for product markup
+    if not app.config["FRAGMENT_CACHE"] or app.jinja_env.auto_reload:
+        return Markup(app.jinja_env.get_template(template).render(**context))
+    hit = _fragments.get(key)
+    if hit and hit[0] == version:
+        return hit[1]
+    html = Markup(app.jinja_env.get_template(template).render(**context))
+    _fragments[key] = (version, html)
+    return html
+
+def precompile_templates():
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+@app.context_processor
+def inject_idempotency_token():
+    # fresh key per rendered form; resubmitting the same form replays the first result
+    return {"idempotency_token": lambda: uuid.uuid4().hex}
+
 def get_cart():
     c = session.get("cart") or {}
     return {int(k): int(v) for k, v in c.items()}
@@ -183,17 +761,26 @@ def save_cart(cart):
 def clear_cart():
     session["cart"] = {}
 
+def prepare_db():
+    if IS_VERCEL:
+        restore_snapshot()
+    if not schema_is_current():
+        init_db()
+
 @app.before_request
 def ensure_db():
-    init_db()
+    global _db_ready
+    if _db_ready:
+        return
+    prepare_db()
+    start_outbox_dispatcher()
+    if not IS_VERCEL:
+        precompile_templates()
+    _db_ready = True
 
 @app.route("/")
 def index():
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM products ORDER BY id DESC")
-    products = cur.fetchall()
-    conn.close()
+    _, products, _ = get_catalog()
     return render_template("index.html", products=products)
 
 @app.route("/signup", methods=["GET", "POST"])
@@ -209,6 +796,7 @@ def signup():
         conn = get_db()
         cur = conn.cursor()
         try:
+            begin_write(conn)
             cur.execute(
                 "INSERT INTO users (name, email, phone, password_hash, role, created_at) VALUES (?, ?, ?, ?, ?, ?)",
                 (
@@ -220,6 +808,7 @@ def signup():
                     datetime.utcnow().isoformat(),
                 ),
             )
+            bump_metric(cur, f"signups:{today()}", 1)
             conn.commit()
             sync_excel_all()
             flash("Signup successful")
@@ -280,7 +869,15 @@ def admin_login():
 def admin_dashboard():
     if not require_role("admin"):
         return redirect(url_for("admin_login"))
-    return render_template("admin_dashboard.html")
+    return render_template("admin_dashboard.html", metrics=dashboard_metrics())
+
+@app.route("/admin/metrics")
+def admin_metrics():
+    if not require_role("admin"):
+        return jsonify({"ok": False, "error": "admin login required"}), 401
+    resp = jsonify(dashboard_metrics())
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
 
 @app.route("/admin/products")
 def admin_products():
@@ -305,10 +902,14 @@ def admin_products_new():
         image_url = request.form.get("image_url")
         conn = get_db()
         cur = conn.cursor()
+        begin_write(conn)
         cur.execute(
-            "INSERT INTO products (name, description, price, stock, created_at, image_url) VALUES (?, ?, ?, ?, ?, ?)",
-            (name, description, price, stock, datetime.utcnow().isoformat(), image_url),
+            "INSERT INTO products (name, description, price, stock, created_at, image_url) VALUES (?, ?, ?, 0, ?, ?)",
+            (name, description, price, datetime.utcnow().isoformat(), image_url),
         )
+        pid = cur.lastrowid
+        bump_metric(cur, "products:out_of_stock", 1)
+        move_stock(cur, pid, stock, "initial")
         conn.commit()
         conn.close()
         sync_excel_all()
@@ -330,10 +931,17 @@ def admin_products_edit(pid):
         price = float(request.form.get("price"))
         stock = int(request.form.get("stock"))
         image_url = request.form.get("image_url")
+        begin_write(conn)
+        cur.execute("SELECT stock FROM products WHERE id=?", (pid,))
+        current = cur.fetchone()
         cur.execute(
-            "UPDATE products SET name=?, description=?, price=?, stock=?, image_url=? WHERE id=?",
-            (name, description, price, stock, image_url, pid),
+            "UPDATE products SET name=?, description=?, price=?, image_url=? WHERE id=?",
+            (name, description, price, image_url, pid),
         )
+        if current and stock != current["stock"]:
+            move_stock(cur, pid, stock - current["stock"], "adjustment")
+        else:
+            touch_product(cur, pid)
         conn.commit()
         conn.close()
         sync_excel_all()
@@ -348,7 +956,13 @@ def admin_products_delete(pid):
         return redirect(url_for("admin_login"))
     conn = get_db()
     cur = conn.cursor()
+    begin_write(conn)
+    cur.execute("SELECT stock FROM products WHERE id=?", (pid,))
+    product = cur.fetchone()
+    if product and product["stock"] <= 0:
+        bump_metric(cur, "products:out_of_stock", -1)
     cur.execute("DELETE FROM products WHERE id=?", (pid,))
+    bump_version(cur, "catalog_epoch")
     conn.commit()
     conn.close()
     sync_excel_all()
@@ -378,10 +992,12 @@ def admin_customers_new():
         conn = get_db()
         cur = conn.cursor()
         try:
+            begin_write(conn)
             cur.execute(
                 "INSERT INTO users (name, email, phone, password_hash, role, created_at) VALUES (?, ?, ?, ?, 'customer', ?)",
                 (name, email, phone, generate_password_hash(password), datetime.utcnow().isoformat()),
             )
+            bump_metric(cur, f"signups:{today()}", 1)
             conn.commit()
             sync_excel_all()
             flash("Customer created")
@@ -404,6 +1020,7 @@ def admin_customers_edit(cid):
         name = request.form.get("name")
         email = request.form.get("email")
         phone = request.form.get("phone")
+        begin_write(conn)
         cur.execute(
             "UPDATE users SET name=?, email=?, phone=? WHERE id=?",
             (name, email, phone, cid),
@@ -422,6 +1039,11 @@ def admin_customers_delete(cid):
         return redirect(url_for("admin_login"))
     conn = get_db()
     cur = conn.cursor()
+    begin_write(conn)
+    cur.execute("SELECT role, date(created_at) AS day FROM users WHERE id=?", (cid,))
+    user = cur.fetchone()
+    if user and user["role"] == "customer":
+        bump_metric(cur, f"signups:{user['day']}", -1)
     cur.execute("DELETE FROM users WHERE id=?", (cid,))
     conn.commit()
     conn.close()
@@ -454,7 +1076,14 @@ def admin_order_dispatch(oid):
         return redirect(url_for("admin_login"))
     conn = get_db()
     cur = conn.cursor()
-    cur.execute("UPDATE orders SET status='dispatched' WHERE id=?", (oid,))
+    begin_write(conn)
+    try:
+        set_order_status(cur, oid, "dispatched")
+    except ValueError as e:
+        conn.rollback()
+        conn.close()
+        flash(str(e))
+        return redirect(url_for("admin_orders"))
     conn.commit()
     conn.close()
     flash("Order dispatched")
@@ -466,10 +1095,12 @@ def admin_order_confirm(oid):
         return redirect(url_for("admin_login"))
     conn = get_db()
     cur = conn.cursor()
+    begin_write(conn)
     cur.execute("SELECT * FROM orders WHERE id=?", (oid,))
     order = cur.fetchone()
     cur.execute("SELECT * FROM payments WHERE order_id=? ORDER BY id DESC", (oid,))
     payment = cur.fetchone()
+    settle_payment(cur, payment)
     if payment:
         cur.execute("UPDATE payments SET status='success', paid_at=? WHERE id=?", (datetime.utcnow().isoformat(), payment["id"]))
     else:
@@ -477,7 +1108,13 @@ def admin_order_confirm(oid):
             "INSERT INTO payments (order_id, amount, method, status, transaction_id, paid_at) VALUES (?, ?, 'upi', 'success', ?, ?)",
             (oid, order["total"], f"ADMINCONF{int(datetime.utcnow().timestamp())}{oid}", datetime.utcnow().isoformat()),
         )
-    cur.execute("UPDATE orders SET status='confirmed' WHERE id=?", (oid,))
+    try:
+        set_order_status(cur, oid, "confirmed")
+    except ValueError as e:
+        conn.rollback()
+        conn.close()
+        flash(str(e))
+        return redirect(url_for("admin_orders"))
     conn.commit()
     conn.close()
     sync_excel_all()
@@ -491,10 +1128,13 @@ def admin_order_reject(oid):
     notes = request.form.get("notes") or ""
     conn = get_db()
     cur = conn.cursor()
+    begin_write(conn)
     cur.execute("SELECT * FROM orders WHERE id=?", (oid,))
     order = cur.fetchone()
     cur.execute("SELECT * FROM payments WHERE order_id=? ORDER BY id DESC", (oid,))
     payment = cur.fetchone()
+    set_order_status(cur, oid, "cancelled")
+    settle_payment(cur, payment)
     if payment:
         cur.execute("UPDATE payments SET status='failed', notes=?, paid_at=? WHERE id=?", (notes, datetime.utcnow().isoformat(), payment["id"]))
     else:
@@ -502,7 +1142,6 @@ def admin_order_reject(oid):
             "INSERT INTO payments (order_id, amount, method, status, transaction_id, paid_at, notes) VALUES (?, ?, 'upi', 'failed', ?, ?, ?)",
             (oid, order["total"], f"ADMINREJ{int(datetime.utcnow().timestamp())}{oid}", datetime.utcnow().isoformat(), notes),
         )
-    cur.execute("UPDATE orders SET status='cancelled' WHERE id=?", (oid,))
     conn.commit()
     conn.close()
     sync_excel_all()
@@ -539,17 +1178,19 @@ def admin_orders_new():
             flash("Add at least one item")
             return redirect(url_for("admin_orders_new"))
         total = sum(q * price for _, q, price in items)
+        begin_write(conn)
         cur.execute(
             "INSERT INTO orders (customer_id, status, total, created_at, shipping_address, door_no, street, landmark, place, district, state, alt_mobile, pincode) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
             (customer_id, "pending", total, datetime.utcnow().isoformat(), shipping_address, door_no, street, landmark, place, district, state, alt_mobile, pincode),
         )
         oid = cur.lastrowid
+        record_new_order(cur, oid, total)
         for pid, qty, price in items:
             cur.execute(
                 "INSERT INTO order_items (order_id, product_id, quantity, price) VALUES (?, ?, ?, ?)",
                 (oid, pid, qty, price),
             )
-            cur.execute("UPDATE products SET stock = stock - ? WHERE id=?", (qty, pid))
+            move_stock(cur, pid, -qty, "order", oid)
         conn.commit()
         conn.close()
         sync_excel_all()
@@ -560,11 +1201,8 @@ def admin_orders_new():
 
 @app.route("/product/<int:pid>")
 def product_detail(pid):
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM products WHERE id=?", (pid,))
-    product = cur.fetchone()
-    conn.close()
+    _, _, by_id = get_catalog()
+    product = by_id.get(pid)
     return render_template("product_detail.html", product=product)
 
 @app.route("/order/create", methods=["POST"])
@@ -573,6 +1211,11 @@ def create_order():
     if not u:
         flash("Please signup to place an order")
         return redirect(url_for("signup"))
+    key = idempotency_key()
+    oid = replayed_order(key, "create_order", u["id"])
+    if oid:
+        flash("Order already created")
+        return redirect(url_for("invoice", oid=oid))
     pid = int(request.form.get("product_id"))
     qty = int(request.form.get("quantity"))
     door_no = request.form.get("door_no")
@@ -586,6 +1229,7 @@ def create_order():
     shipping_address = ", ".join(filter(None, [door_no, street, landmark, place, district, state])) + (f" - {pincode}" if pincode else "")
     conn = get_db()
     cur = conn.cursor()
+    begin_write(conn)
     cur.execute("SELECT * FROM products WHERE id=?", (pid,))
     p = cur.fetchone()
     if not p or qty <= 0 or p["stock"] < qty:
@@ -598,11 +1242,19 @@ def create_order():
         (u["id"], "pending", total, datetime.utcnow().isoformat(), shipping_address, door_no, street, landmark, place, district, state, alt_mobile, pincode),
     )
     oid = cur.lastrowid
+    record_new_order(cur, oid, total)
     cur.execute(
         "INSERT INTO order_items (order_id, product_id, quantity, price) VALUES (?, ?, ?, ?)",
         (oid, pid, qty, p["price"]),
     )
-    cur.execute("UPDATE products SET stock = stock - ? WHERE id=?", (qty, pid))
+    move_stock(cur, pid, -qty, "order", oid)
+    try:
+        remember_request(cur, key, "create_order", u["id"], oid)
+    except sqlite3.IntegrityError:
+        conn.rollback()
+        conn.close()
+        flash("Order already created")
+        return redirect(url_for("invoice", oid=replayed_order(key, "create_order", u["id"])))
     conn.commit()
     conn.close()
     sync_excel_all()
@@ -660,21 +1312,76 @@ def pay_order(oid):
             conn.close()
             flash("Enter transaction reference")
             return redirect(url_for("pay_order", oid=oid))
+        key = idempotency_key()
+        begin_write(conn)
+        cur.execute("SELECT order_id FROM payments WHERE transaction_id=?", (transaction_ref,))
+        used = cur.fetchone()
+        if used and used["order_id"] == oid:
+            conn.close()
+            flash("Payment already submitted. Pending admin confirmation.")
+            return redirect(url_for("invoice", oid=oid))
+        if used:
+            conn.close()
+            flash("This transaction reference was already used for another order")
+            return redirect(url_for("pay_order", oid=oid))
+        cur.execute("SELECT status FROM payments WHERE order_id=? ORDER BY id DESC LIMIT 1", (oid,))
+        latest = cur.fetchone()
+        if not latest or latest["status"] != "submitted":
+            bump_metric(cur, "payments:submitted", 1)
         cur.execute(
             "INSERT INTO payments (order_id, amount, method, status, transaction_id, paid_at) VALUES (?, ?, ?, ?, ?, ?)",
             (oid, order["total"], method, "submitted", transaction_ref, datetime.utcnow().isoformat()),
         )
-        cur.execute("UPDATE orders SET status='pending' WHERE id=?", (oid,))
+        try:
+            set_order_status(cur, oid, "pending")
+        except ValueError:
+            conn.rollback()
+            conn.close()
+            flash("This order was cancelled and its items are out of stock. Please place a new order.")
+            return redirect(url_for("invoice", oid=oid))
         msg = "Payment submitted. Pending admin confirmation."
+        try:
+            remember_request(cur, key, "pay_order", session.get("user_id"), oid)
+        except sqlite3.IntegrityError:
+            conn.rollback()
+            conn.close()
+            flash("Payment already submitted. Pending admin confirmation.")
+            return redirect(url_for("invoice", oid=oid))
         conn.commit()
         conn.close()
         sync_excel_all()
         flash(msg)
         return redirect(url_for("invoice", oid=oid))
-    upi_uri = f"upi://pay?pa=7418304663@upi&pn=MGM%20Cloths&am={order['total']}&cu=INR&tn=Order%20{oid}"
-    qr_data = quote(upi_uri, safe="")
+    upi_uri = build_upi_uri(order)
+    conn.close()
+    return render_template("pay.html", order=order, upi_uri=upi_uri, qr_version=qr_etag(upi_uri, "svg"))
+
+@app.route("/order/<int:oid>/qr.<fmt>")
+def order_qr(oid, fmt):
+    if fmt not in ("png", "svg"):
+        return make_response("Unsupported format", 404)
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("SELECT id, total FROM orders WHERE id=?", (oid,))
+    order = cur.fetchone()
     conn.close()
-    return render_template("pay.html", order=order, upi_uri=upi_uri, qr_data=qr_data)
+    if not order:
+        return make_response("Order not found", 404)
+    uri = build_upi_uri(order)
+    etag = qr_etag(uri, fmt)
+    if request.if_none_match.contains(etag):
+        resp = make_response("", 304)
+    else:
+        resp = make_response(qr_image(uri, fmt))
+        resp.headers["Content-Type"] = "image/png" if fmt == "png" else "image/svg+xml"
+    resp.set_etag(etag)
+    if request.args.get("v") == etag:
+        # the version pins the exact payment URI, so this URL's image can never change
+        resp.headers["Cache-Control"] = "private, max-age=31536000, immutable"
+    else:
+        # order ids can be reused after a restore, so unversioned URLs always revalidate
+        resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
 
 
 @app.route("/admin/sales-report")
@@ -709,6 +1416,52 @@ def sales_report():
     conn.close()
     return render_template("sales_report.html", summary=summary, selected=selected, orders=orders)
 
+@app.route("/admin/low-stock")
+def low_stock_report():
+    if not require_role("admin"):
+        return redirect(url_for("admin_login"))
+    threshold = request.args.get("threshold", LOW_STOCK_THRESHOLD, type=int)
+    conn = get_db()
+    cur = conn.cursor()
+    # range scan on idx_products_stock
+    cur.execute("SELECT * FROM products WHERE stock <= ? ORDER BY stock, id", (threshold,))
+    products = cur.fetchall()
+    conn.close()
+    return render_template("low_stock.html", products=products, threshold=threshold)
+
+@app.route("/admin/backup", methods=["POST"])
+def admin_backup():
+    if not require_role("admin"):
+        return redirect(url_for("admin_login"))
+    path = backup_db(compress=bool(request.form.get("compress")))
+    return send_file(path, as_attachment=True, download_name=os.path.basename(path))
+
+@app.route("/events")
+def event_feed():
+    token = (request.headers.get("Authorization") or "").removeprefix("Bearer ")
+    if not (require_role("admin") or (EVENTS_TOKEN and token == EVENTS_TOKEN)):
+        return jsonify({"ok": False, "error": "admin login or events token required"}), 401
+    after = request.args.get("after", request.headers.get("Last-Event-ID", 0), type=int)
+    limit = max(1, min(request.args.get("limit", 100, type=int), 1000))
+    if "text/event-stream" in (request.headers.get("Accept") or ""):
+        def stream(cursor):
+            deadline = time.monotonic() + EVENT_STREAM_SECONDS
+            # EventSource reconnects after `retry` ms and sends the last id it saw
+            yield "retry: 1000\n\n"
+            while time.monotonic() < deadline:
+                events = read_events(cursor, limit)
+                for e in events:
+                    cursor = e["id"]
+                    yield f"id: {e['id']}\nevent: {e['event']}\ndata: {json.dumps(e)}\n\n"
+                if not events:
+                    time.sleep(1)
+        return Response(stream(after), mimetype="text/event-stream", headers={"Cache-Control": "no-store"})
+    events = read_events(after, limit)
+    body = "".join(json.dumps(e) + "\n" for e in events)
+    resp = Response(body, mimetype="application/x-ndjson")
+    resp.headers["X-Next-Cursor"] = str(events[-1]["id"] if events else after)
+    return resp
+
 @app.route("/excel/export/all")
 def export_all_excel():
     if not require_role("admin"):
@@ -722,18 +1475,15 @@ def view_cart():
     cart = get_cart()
     if not cart:
         return render_template("cart.html", items=[], total=0)
-    conn = get_db()
-    cur = conn.cursor()
+    _, _, by_id = get_catalog()
     items = []
     total = 0
     for pid, qty in cart.items():
-        cur.execute("SELECT id, name, price, stock FROM products WHERE id=?", (pid,))
-        p = cur.fetchone()
+        p = by_id.get(pid)
         if p:
             subtotal = p["price"] * qty
             total += subtotal
             items.append({"id": p["id"], "name": p["name"], "price": p["price"], "stock": p["stock"], "qty": qty, "subtotal": subtotal})
-    conn.close()
     return render_template("cart.html", items=items, total=total)
 
 @app.route("/cart/add", methods=["POST"])
@@ -775,6 +1525,12 @@ def cart_clear():
 def cart_checkout():
     u = current_user()
     cart = get_cart()
+    key = idempotency_key()
+    oid = replayed_order(key, "cart_checkout", u["id"]) if u else None
+    if oid:
+        clear_cart()
+        flash("Order already placed. Please complete payment.")
+        return redirect(url_for("pay_order", oid=oid))
     if not cart:
         flash("Cart is empty")
         return redirect(url_for("view_cart"))
@@ -792,6 +1548,7 @@ def cart_checkout():
     shipping_address = ", ".join(filter(None, [door_no, street, landmark, place, district, state])) + (f" - {pincode}" if pincode else "")
     conn = get_db()
     cur = conn.cursor()
+    begin_write(conn)
     items = []
     total = 0
     for pid, qty in cart.items():
@@ -809,12 +1566,21 @@ def cart_checkout():
         (u["id"], "pending", total, datetime.utcnow().isoformat(), shipping_address, door_no, street, landmark, place, district, state, alt_mobile, pincode),
     )
     oid = cur.lastrowid
+    record_new_order(cur, oid, total)
     for pid, qty, price in items:
         cur.execute(
             "INSERT INTO order_items (order_id, product_id, quantity, price) VALUES (?, ?, ?, ?)",
             (oid, pid, qty, price),
         )
-        cur.execute("UPDATE products SET stock = stock - ? WHERE id=?", (qty, pid))
+        move_stock(cur, pid, -qty, "order", oid)
+    try:
+        remember_request(cur, key, "cart_checkout", u["id"], oid)
+    except sqlite3.IntegrityError:
+        conn.rollback()
+        conn.close()
+        clear_cart()
+        flash("Order already placed. Please complete payment.")
+        return redirect(url_for("pay_order", oid=replayed_order(key, "cart_checkout", u["id"])))
     conn.commit()
     conn.close()
     clear_cart()
@@ -839,14 +1605,13 @@ def my_orders():
 def contact():
     return render_template("contact.html")
 
-if __name__ == "__main__":
-    app.run(host="127.0.0.1", port=5000, debug=True)
 @app.route("/admin/orders/<int:oid>/verify", methods=["POST"])
 def admin_order_verify(oid):
     if not require_role("admin"):
         return redirect(url_for("admin_login"))
     conn = get_db()
     cur = conn.cursor()
+    begin_write(conn)
     cur.execute("SELECT * FROM orders WHERE id=?", (oid,))
     order = cur.fetchone()
     cur.execute("SELECT * FROM payments WHERE order_id=? ORDER BY id DESC", (oid,))
@@ -854,12 +1619,22 @@ def admin_order_verify(oid):
     action = request.form.get("action")
     notes = request.form.get("notes") or ""
     if action == "confirm":
+        settle_payment(cur, payment)
         cur.execute("UPDATE payments SET status='success', paid_at=?, notes=? WHERE id=?", (datetime.utcnow().isoformat(), notes, payment["id"]))
-        cur.execute("UPDATE orders SET status='confirmed' WHERE id=?", (oid,))
+        try:
+            set_order_status(cur, oid, "confirmed")
+        except ValueError as e:
+            conn.rollback()
+            conn.close()
+            if "application/json" in (request.headers.get("Accept") or ""):
+                return jsonify({"ok": False, "error": str(e)}), 409
+            flash(str(e))
+            return redirect(url_for("admin_orders"))
         flash("Payment confirmed. Order marked as confirmed.")
     elif action == "reject":
+        settle_payment(cur, payment)
+        set_order_status(cur, oid, "cancelled")
         cur.execute("UPDATE payments SET status='failed', paid_at=?, notes=? WHERE id=?", (datetime.utcnow().isoformat(), notes, payment["id"]))
-        cur.execute("UPDATE orders SET status='cancelled' WHERE id=?", (oid,))
         flash("Payment rejected. Order cancelled.")
     conn.commit()
     txn = payment["transaction_id"] if payment else None
@@ -869,3 +1644,98 @@ def admin_order_verify(oid):
     if "application/json" in (request.headers.get("Accept") or ""):
         return jsonify({"ok": True, "status": status, "txn": txn})
     return redirect(url_for("admin_orders"))
+
+@app.cli.command("reconcile-stock")
+def reconcile_stock():
+    """Recompute products.stock from the inventory ledger and fix any drift."""
+    if not schema_is_current():
+        init_db()
+    conn = get_db()
+    cur = conn.cursor()
+    begin_write(conn)
+    cur.execute("""
+        SELECT p.id, p.name, p.stock, COALESCE(SUM(m.delta), 0) AS ledger
+        FROM products p
+        LEFT JOIN inventory_movements m ON m.product_id = p.id
+        GROUP BY p.id
+        HAVING p.stock != ledger
+    """)
+    drifted = cur.fetchall()
+    for p in drifted:
+        cur.execute("UPDATE products SET stock=? WHERE id=?", (p["ledger"], p["id"]))
+        change = int(p["ledger"] <= 0) - int(p["stock"] <= 0)
+        if change:
+            bump_metric(cur, "products:out_of_stock", change)
+        print(f"#{p['id']} {p['name']}: stock {p['stock']} -> {p['ledger']}")
+        touch_product(cur, p["id"])
+    conn.commit()
+    conn.close()
+    print(f"{len(drifted)} product(s) reconciled")
+
+@app.cli.command("rebuild-metrics")
+def rebuild_metrics_command():
+    """Recompute dashboard counters from a full scan of the tables."""
+    if not schema_is_current():
+        init_db()
+    conn = get_db()
+    cur = conn.cursor()
+    begin_write(conn)
+    rebuild_metrics(cur)
+    conn.commit()
+    conn.close()
+    print("Metrics rebuilt")
+
+@app.cli.command("backup")
+@click.option("--compress", is_flag=True, help="gzip the snapshot")
+@click.option("--keep", default=BACKUP_KEEP, show_default=True, help="number of snapshots to retain")
+def backup_command(compress, keep):
+    """Take an online snapshot of the database into backups/."""
+    print(f"Backup written to {backup_db(compress=compress, keep=keep)}")
+
+@app.cli.command("restore")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+def restore_command(path):
+    """Verify a snapshot with PRAGMA integrity_check and restore it over the live database."""
+    try:
+        restore_db(path)
+    except (ValueError, OSError, sqlite3.DatabaseError) as e:
+        raise click.ClickException(str(e))
+    print(f"Restored {path}")
+
+@app.cli.command("dispatch-events")
+@click.option("--once", is_flag=True, help="deliver pending events and exit")
+def dispatch_events_command(once):
+    """Deliver outbox events to WEBHOOK_URLS."""
+    if not WEBHOOK_URLS:
+        raise click.ClickException("WEBHOOK_URLS is not set")
+    if not schema_is_current():
+        init_db()
+    if not once:
+        run_outbox_dispatcher()
+    total = 0
+    while True:
+        sent = dispatch_outbox()
+        total += sent
+        if sent < OUTBOX_BATCH:
+            break
+    print(f"{total} event(s) delivered")
+
+@app.cli.command("build-snapshot")
+def build_snapshot():
+    """Rebuild snapshot/mgm_store.db from an empty, freshly seeded database."""
+    global DB_PATH
+    os.makedirs(os.path.dirname(SNAPSHOT_PATH), exist_ok=True)
+    if os.path.exists(SNAPSHOT_PATH):
+        os.remove(SNAPSHOT_PATH)
+    live_path, DB_PATH = DB_PATH, SNAPSHOT_PATH
+    try:
+        init_db()
+        conn = get_db()
+        conn.execute("VACUUM")
+        conn.close()
+    finally:
+        DB_PATH = live_path
+    print(f"Snapshot written to {SNAPSHOT_PATH}")
+
+if __name__ == "__main__":
+    app.run(host="127.0.0.1", port=5000, debug=True)
@@ -0,0 +1,19 @@
+# Production server config: gunicorn -c gunicorn.conf.py
+# Each worker keeps its own product cache; caches are invalidated through the
+# catalog_version counter in the database, so workers share nothing in memory.
+import multiprocessing
+import os
+
+wsgi_app = "app:app"
+bind = os.environ.get("BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get("THREADS", 2))
+preload_app = True
+timeout = 30
+accesslog = "-"
+
+
+def on_starting(server):
+    # the app is already imported (preload_app); migrate once here instead of in every worker
+    from app import prepare_db
+    prepare_db()
@@ -0,0 +1,56 @@
+"""Measure import-to-first-response time of a cold serverless instance.
+
+Every run starts a fresh interpreter with VERCEL=1 and an empty TMPDIR, which is
+what a new Vercel instance sees. Runs are repeated with and without the prebuilt
+snapshot so the two cold-start paths can be compared.
+
+    python scripts/bench_cold_start.py [runs]
+"""
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+PROBE = """
+import time
+t0 = time.perf_counter()
+import app
+t1 = time.perf_counter()
+if not USE_SNAPSHOT:
+    app.SNAPSHOT_PATH = app.SNAPSHOT_PATH + ".missing"
+resp = app.app.test_client().get("/")
+t2 = time.perf_counter()
+assert resp.status_code == 200, resp.status_code
+print(f"{t1 - t0:.6f} {t2 - t1:.6f}")
+"""
+
+
+def run_once(use_snapshot):
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, VERCEL="1", TMPDIR=tmp)
+        out = subprocess.run(
+            [sys.executable, "-c", f"USE_SNAPSHOT = {use_snapshot}\n" + PROBE],
+            cwd=ROOT, env=env, capture_output=True, text=True, check=True,
+        ).stdout.split()
+    return float(out[0]), float(out[1])
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    for label, use_snapshot in (("seed from scratch", False), ("copy snapshot", True)):
+        samples = [run_once(use_snapshot) for _ in range(runs)]
+        imports = [s[0] * 1000 for s in samples]
+        firsts = [s[1] * 1000 for s in samples]
+        totals = [a + b for a, b in zip(imports, firsts)]
+        print(
+            f"{label:>18}: import {statistics.median(imports):7.1f} ms  "
+            f"first response {statistics.median(firsts):7.1f} ms  "
+            f"total {statistics.median(totals):7.1f} ms  (median of {runs})"
+        )
+
+
+if __name__ == "__main__":
+    main()
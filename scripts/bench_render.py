@@ -0,0 +1,103 @@
+"""Compare storefront render time with and without template fragment caching.
+
+Builds a throwaway database per catalog size, then times GET / and a product
+page through the test client uncached (FRAGMENT_CACHE off and the product
+cache dropped before every request, i.e. a full reload and render), cached with
+a warm cache, and on with one order placed before every request (so the
+stock change has to reach the catalog and the touched card). Also reports cold
+template load time with and without the Jinja bytecode cache.
+
+    python scripts/bench_render.py [runs]
+"""
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import app  # noqa: E402
+
+SIZES = (100, 1000, 10000)
+
+
+def drop_catalog_cache(_=None):
+    app._catalog_cache = (None, None, [], {})
+
+
+def build_db(path, n):
+    app.DB_PATH = path
+    # every fresh database starts at the same catalog_version, so drop per-process caches
+    drop_catalog_cache()
+    app._fragments.clear()
+    app.init_db()
+    conn = app.get_db()
+    conn.executemany(
+        "INSERT INTO products (name, description, price, stock, created_at) VALUES (?, ?, ?, ?, ?)",
+        [(f"Product {i}", f"Description of product {i}", 100 + i * 0.25, i % 40, "2024-01-01") for i in range(n)],
+    )
+    conn.execute("UPDATE meta SET value = value + 1 WHERE key='catalog_version'")
+    conn.commit()
+    conn.close()
+
+
+def place_order(pid):
+    conn = app.get_db()
+    cur = conn.cursor()
+    app.begin_write(conn)
+    app.move_stock(cur, pid, -1, "order")
+    conn.commit()
+    conn.close()
+
+
+def timed(client, url, runs, between=None):
+    samples = []
+    for i in range(runs):
+        if between:
+            between(i)
+        t0 = time.perf_counter()
+        resp = client.get(url)
+        samples.append((time.perf_counter() - t0) * 1000)
+        assert resp.status_code == 200, resp.status_code
+    return statistics.median(samples)
+
+
+def bench_template_load():
+    env = app.app.jinja_env
+    cache = env.bytecode_cache
+    cache.clear()
+    results = []
+    for label in ("compile from source", "load from bytecode cache"):
+        env.cache.clear()
+        t0 = time.perf_counter()
+        app.precompile_templates()
+        results.append((label, (time.perf_counter() - t0) * 1000))
+    return results
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    app.app.jinja_env.auto_reload = False
+    for label, ms in bench_template_load():
+        print(f"templates, {label:>26}: {ms:8.2f} ms")
+    print(f"{'products':>8} {'page':>11} {'uncached':>10} {'cached':>10} {'+orders':>10} {'speedup':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in SIZES:
+            build_db(os.path.join(tmp, f"bench-{n}.db"), n)
+            client = app.app.test_client()
+            client.get("/")
+            for page in ("/", "/product/1"):
+                app.app.config["FRAGMENT_CACHE"] = False
+                before = timed(client, page, runs, between=drop_catalog_cache)
+                app.app.config["FRAGMENT_CACHE"] = True
+                client.get(page)
+                after = timed(client, page, runs)
+                # the product page sells its own product; the storefront sells a different one each time
+                pid = lambda i: 1 if page != "/" else i % n + 1
+                writes = timed(client, page, runs, between=lambda i: place_order(pid(i)))
+                print(f"{n:>8} {page:>11} {before:>8.2f}ms {after:>8.2f}ms {writes:>8.2f}ms {before / writes:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""Local webhook receiver for testing the order event dispatcher.
+
+    python scripts/webhook_stub.py [--port 8099] [--fail-rate 0.3]
+    WEBHOOK_URLS=http://127.0.0.1:8099/hook flask --app app dispatch-events
+
+Prints every event it receives. With --fail-rate it answers a share of the
+requests with HTTP 500, which makes the dispatcher retry with backoff.
+"""
+import argparse
+import json
+import random
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+def make_handler(fail_rate, seen):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            if random.random() < fail_rate:
+                self.send_response(500)
+                self.end_headers()
+                print("-> simulated failure")
+                return
+            events = json.loads(body)["events"]
+            for e in events:
+                dup = " (duplicate)" if e["id"] in seen else ""
+                seen.add(e["id"])
+                print(f"#{e['id']} {e['event']} order={e['order_id']} {e['data']}{dup}")
+            self.send_response(204)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    server = HTTPServer(("127.0.0.1", args.port), make_handler(args.fail_rate, set()))
+    print(f"Listening on http://127.0.0.1:{args.port}/hook")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,15 @@
+# Production server for platforms without gunicorn (e.g. Windows): python serve.py
+import multiprocessing
+import os
+
+from waitress import serve
+
+from app import app
+
+if __name__ == "__main__":
+    serve(
+        app,
+        host=os.environ.get("HOST", "0.0.0.0"),
+        port=int(os.environ.get("PORT", 8000)),
+        threads=int(os.environ.get("THREADS", multiprocessing.cpu_count() * 2)),
+    )